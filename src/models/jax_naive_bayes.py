@@ -0,0 +1,73 @@
+from functools import partial
+import numpy as np
+import jax
+import jax.numpy as jnp
+from jax.scipy.special import logsumexp
+from sklearn.naive_bayes import GaussianNB
+
+
+@partial(jax.jit, static_argnames='n_classes')
+def fit(X, y, var_smoothing, n_classes: int):
+    """ Estimates the class means, variances and priors of a Gaussian Naive Bayes model.
+
+    Args:
+        X (jnp.ndarray): Training features
+        y (jnp.ndarray): Training labels encoded as 0, ..., n_classes - 1
+        var_smoothing (float): Portion of the largest feature variance added to the variances
+        n_classes (int): Number of classes
+
+    Returns:
+        means (jnp.ndarray): Array of shape (classes, features)
+        vars (jnp.ndarray): Array of shape (classes, features)
+        priors (jnp.ndarray): Array of shape (classes,)
+
+    """
+    one_hot = jax.nn.one_hot(y, n_classes, dtype=X.dtype)
+    counts = one_hot.sum(axis=0)
+    means = one_hot.T @ X / counts[:, None]
+    vars = (one_hot.T[:, :, None] * (X[None, :, :] - means[:, None, :]) ** 2).sum(axis=1) / counts[:, None]
+    vars = vars + var_smoothing * X.var(axis=0).max()
+    return means, vars, counts / counts.sum()
+
+
+@jax.jit
+def predict_proba(X, means, vars, priors):
+    """ Predicts class probabilities of a Gaussian Naive Bayes model.
+
+    Args:
+        X (jnp.ndarray): Features
+        means (jnp.ndarray): Class means as returned by fit
+        vars (jnp.ndarray): Class variances as returned by fit
+        priors (jnp.ndarray): Class priors
+
+    Returns:
+        probabilities (jnp.ndarray): Array of shape (samples, classes)
+
+    """
+    joint_log_likelihood = jnp.log(priors) - 0.5 * jnp.log(2. * jnp.pi * vars).sum(axis=1) \
+        - 0.5 * ((X[:, None, :] - means[None, :, :]) ** 2 / vars[None, :, :]).sum(axis=2)
+    return jnp.exp(joint_log_likelihood - logsumexp(joint_log_likelihood, axis=1, keepdims=True))
+
+
+def fit_predict_proba(model: GaussianNB, X, y, X_test) -> np.ndarray:
+    """ Fits a GaussianNB with the hyperparameters of model and predicts class probabilities on X_test.
+
+    The kernels run in float64 so that probabilities close to 1 stay distinct and the ranking matches sklearn.
+
+    Args:
+        model (GaussianNB): Model whose hyperparameters are used
+        X (pd.DataFrame): Training features
+        y (pd.Series): Training labels
+        X_test (pd.DataFrame): Test features
+
+    Returns:
+        probabilities (np.ndarray): Array of shape (samples, classes)
+
+    """
+    classes, y_encoded = np.unique(np.asarray(y), return_inverse=True)
+    with jax.enable_x64(True):
+        means, vars, priors = fit(jnp.asarray(X.to_numpy(dtype=np.float64)), jnp.asarray(y_encoded),
+                                  model.var_smoothing, len(classes))
+        if model.priors is not None:
+            priors = jnp.asarray(model.priors, dtype=np.float64)
+        return np.asarray(predict_proba(jnp.asarray(X_test.to_numpy(dtype=np.float64)), means, vars, priors))
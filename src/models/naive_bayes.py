@@ -0,0 +1,113 @@
+import numpy as np
+from scipy.special import logsumexp
+from sklearn.naive_bayes import GaussianNB
+
+
+class IncrementalGaussianNB(object):
+    """ A class to score growing feature sets of a GaussianNB without refitting.
+
+    The class-conditional likelihoods of a GaussianNB factorize over the features, so the joint log-likelihood of a
+    feature set is the sum of the per-feature log-likelihoods. The model is fitted once on all features and candidate
+    feature sets are scored by adding the contribution of the new feature to the accumulated log-likelihood of the
+    already selected ones.
+
+    Attributes:
+        columns (list): Names of all features
+        added_columns (list): Names of the selected features
+
+    Methods:
+        predict_proba(feature: str):
+            Returns class probabilities on the test set for the selected features plus feature
+        add(feature: str):
+            Adds feature to the selected features
+    """
+
+    def __init__(self, model: GaussianNB, X, y, X_test):
+        """ Constructs IncrementalGaussianNB object.
+
+        Args:
+            model (GaussianNB): Model whose hyperparameters are used
+            X (pd.DataFrame): Training features
+            y (pd.Series): Training labels
+            X_test (pd.DataFrame): Test features
+
+        """
+        model.fit(X, y)
+
+        self.columns = list(X.columns)
+        self.added_columns = []
+        self.var_smoothing = model.var_smoothing
+        self.log_prior = np.log(model.class_prior_)
+        self.feature_var = np.var(X.to_numpy(), axis=0)
+        self.class_var = model.var_ - model.epsilon_
+        self.class_mean = model.theta_
+        self.X_test = X_test.to_numpy()
+
+        self.max_var = 0.
+        self.log_likelihood = np.zeros((len(X_test), len(model.classes_)))
+
+    def _feature_log_likelihood(self, index: int, epsilon: float):
+        """ Calculates log p(x_f | c) of one feature for all test samples and classes.
+
+        Args:
+            index (int): Position of the feature
+            epsilon (float): Variance smoothing of the feature set
+
+        Returns:
+            log_likelihood (np.ndarray): Array of shape (samples, classes)
+
+        """
+        var = self.class_var[:, index] + epsilon
+        squared_distances = (self.X_test[:, [index]] - self.class_mean[:, index]) ** 2
+        return -0.5 * np.log(2. * np.pi * var) - 0.5 * squared_distances / var
+
+    def _log_likelihood(self, index: int):
+        """ Calculates the joint log-likelihood of the selected features plus one new feature.
+
+        Args:
+            index (int): Position of the new feature
+
+        Returns:
+            max_var (float): Largest variance among the features
+            log_likelihood (np.ndarray): Array of shape (samples, classes)
+
+        """
+        # GaussianNB smooths with the largest feature variance, which may grow with the new feature
+        max_var = max(self.max_var, self.feature_var[index])
+        epsilon = self.var_smoothing * max_var
+
+        if max_var == self.max_var:
+            return max_var, self.log_likelihood + self._feature_log_likelihood(index, epsilon)
+        indices = [self.columns.index(column) for column in self.added_columns] + [index]
+        return max_var, sum(self._feature_log_likelihood(i, epsilon) for i in indices)
+
+    def predict_proba(self, feature: str):
+        """ Predicts class probabilities on the test set.
+
+        Args:
+            feature (str): Candidate feature to add to the selected features
+
+        Returns:
+            probabilities (np.ndarray): Array of shape (samples, classes)
+
+        """
+        _, log_likelihood = self._log_likelihood(self.columns.index(feature))
+        joint_log_likelihood = log_likelihood + self.log_prior
+        return np.exp(joint_log_likelihood - logsumexp(joint_log_likelihood, axis=1, keepdims=True))
+
+    def add(self, feature: str):
+        """ Adds a feature to the selected features.
+
+        Args:
+            feature (str): Feature to add
+
+        Returns:
+            none
+
+        """
+        index = self.columns.index(feature)
+        if self.feature_var[index] <= self.max_var:
+            self.log_likelihood += self._feature_log_likelihood(index, self.var_smoothing * self.max_var)
+        else:
+            self.max_var, self.log_likelihood = self._log_likelihood(index)
+        self.added_columns.append(feature)
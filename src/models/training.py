@@ -5,9 +5,93 @@ from src.data.preprocessing import split_and_scale
 from src.utils.utils import save, load, check_path_exists
 import os
 import json
-from skopt.utils import use_named_args
-from skopt import gp_minimize
+from numba import njit
+from skopt import Optimizer
+from joblib import Parallel, delayed
+from sklearn.base import clone
 from src.models.pairwise import pairwise_optimize
+from src.models.naive_bayes import IncrementalGaussianNB
+
+
+@njit(cache=True)
+def _query_metrics(relevant, qid_offsets, discounts, threshold):
+    """ Calculates AP, nDCG and RR for every query of a ranked result set.
+
+    Args:
+        relevant (np.ndarray): Feedback sorted by qID and by descending confidence within each query
+        qid_offsets (np.ndarray): Start of every query in the sorted arrays followed by their total length
+        discounts (np.ndarray): 1 / log2(rank + 1) for every rank up to the longest query
+        threshold (int): Minimum feedback for a document to count as a hit for RR
+
+    Returns:
+        AP (np.ndarray): Average precision per query, 0 without relevant passages
+        nDCG (np.ndarray): Normalized discounted cumulative gain per query, 0 without relevant passages
+        RR (np.ndarray): Reciprocal rank per query, 0 without a hit
+
+    """
+    n_queries = len(qid_offsets) - 1
+    # Queries without a relevant passage score 0 in all three metrics and count towards their means
+    ap = np.zeros(n_queries)
+    ndcg = np.zeros(n_queries)
+    rr = np.zeros(n_queries)
+    fallback_threshold = max(threshold - 1, 1)
+
+    for q in range(n_queries):
+        ranked = relevant[qid_offsets[q]:qid_offsets[q + 1]]
+
+        hits = 0
+        precision_sum = 0.
+        dcg = 0.
+        first_hit = 0
+        first_fallback_hit = 0
+        for i in range(len(ranked)):
+            if ranked[i] >= 1:
+                rank = i + 1
+                hits += 1
+                precision_sum += hits / rank
+                dcg += (2. ** ranked[i] - 1.) * discounts[i]
+                if first_hit == 0 and ranked[i] >= threshold:
+                    first_hit = rank
+                if first_fallback_hit == 0 and ranked[i] >= fallback_threshold:
+                    first_fallback_hit = rank
+
+        if hits == 0:
+            continue
+
+        ideal = np.sort(ranked[ranked >= 1])[::-1]
+        idcg = 0.
+        for i in range(len(ideal)):
+            idcg += (2. ** ideal[i] - 1.) * discounts[i]
+
+        ap[q] = precision_sum / hits
+        ndcg[q] = dcg / idcg
+        if first_hit > 0:
+            rr[q] = 1. / first_hit
+        elif first_fallback_hit > 0:
+            rr[q] = 1. / first_fallback_hit
+
+    return ap, ndcg, rr
+
+
+def _predict_proba(model, X, y, X_test, use_jax: bool = False):
+    """ Fits a model and predicts the relevance probabilities of X_test.
+
+    Args:
+        model (): Model to fit
+        X (pd.DataFrame): Training features
+        y (pd.Series): Training labels
+        X_test (pd.DataFrame): Test features
+        use_jax (Boolean): Fit and predict the GaussianNB model with the jitted JAX kernels
+
+    Returns:
+        confidences (np.ndarray): Probability of the relevant class per row of X_test
+
+    """
+    if use_jax:
+        from src.models.jax_naive_bayes import fit_predict_proba
+        return fit_predict_proba(model, X, y, X_test)[:, 1]
+    model.fit(X, y)
+    return model.predict_proba(X_test)[:, 1]
 
 
 class Evaluation(object):
@@ -25,7 +109,8 @@ class Evaluation(object):
                                     X_val: pd.DataFrame, qrels: pd.DataFrame, qrels_val: pd.DataFrame,
                                     k: int = 50, components_pca: int = 0, pairwise_model=None,
                                     pairwise_top_k: int = 50, pairwise_train: bool = True,
-                                    trials: int = 50, name: str = None, save_result: bool = True):
+                                    trials: int = 50, name: str = None, save_result: bool = True,
+                                    jax_gaussian_nb: bool = False, n_jobs: int = 1):
         Performs hyperparameter optimization.
     feature_selection(model, search_space, X_y_train: pd.DataFrame, X_test: pd.DataFrame, X_val: pd.DataFrame,
                             qrels: pd.DataFrame, qrels_val: pd.DataFrame, k: int = 50, components_pca: int = 0,
@@ -33,21 +118,22 @@ class Evaluation(object):
         Performs feature selection.
     compute_metrics(model, X: pd.DataFrame, y, X_test, test_pair, qrels: pd.DataFrame, k: int = 50,
                         components_pca: int = 0, pairwise_model=None, pairwise_top_k: int = 50,
-                        pairwise_train: bool = True, name: str = None, save_result: bool = False):
-        Calculates metrics and saves them in a dataframe locally.
-    calculate_ranks(results: pd.DataFrame):
-        Returns relevant documents with their corresponding rank
-    average_precision_score(results: pd.DataFrame):
-        Calculates Average Precision
+                        pairwise_train: bool = True, name: str = None, save_result: bool = False,
+                        confidences=None, results_buf: pd.DataFrame = None):
+        Calculates metrics and buffers them for flush.
+    results_frame(test_pair: pd.DataFrame, qrels: pd.DataFrame):
+        Returns the query-passage pairs joined with their feedback
+    flush():
+        Appends buffered metrics to the stored results and saves them.
+    query_metrics(results: pd.DataFrame, threshold: int = 3):
+        Calculates AP, nDCG and RR per query
     mean_average_precision_score(results: pd.DataFrame):
         Calculates Mean Average Precision for a set of queries
     metrics(results: pd.DataFrame, k: int = None):
         Calculates accuracy, precision, recall and f1 globally and in the top-k area
-    normalized_discounted_cumulative_gain(results: pd.DataFrame):
-        Calculates Normalized Discounted Cumulative Gain
     mean_normalized_discounted_cumulative_gain_score(results: pd.DataFrame):
         Calculates Mean Normalized Cumulative Gain
-    mean_reciprocal_rank(results: pd.DataFrame):
+    mean_reciprocal_rank(results: pd.DataFrame, threshold: int = 3):
         Calculates Mean Reciprocal Rank
     """
 
@@ -65,6 +151,19 @@ class Evaluation(object):
         else:
             check_path_exists(os.path.dirname(previous_results))
             self.results = pd.DataFrame()
+        self._pending = []
+
+    def flush(self):
+        """ Appends the pending results to the stored results and saves them.
+
+        Returns:
+            none
+
+        """
+        if self._pending:
+            self.results = pd.concat([self.results, pd.DataFrame(self._pending)]).reset_index(drop=True)
+            save(self.results, self.previous_results)
+            self._pending = []
 
     def __call__(self,
                  X_y_train: pd.DataFrame,
@@ -111,6 +210,7 @@ class Evaluation(object):
                                            pairwise_train,
                                            name=name,
                                            save_result=save_result)
+        self.flush()
         print(f'MRR: {performance[0]}')
         print(f'nDCG: {performance[1]}')
 
@@ -127,7 +227,9 @@ class Evaluation(object):
                                     pairwise_train: bool = True,
                                     trials: int = 50,
                                     name: str = None,
-                                    save_result: bool = True
+                                    save_result: bool = True,
+                                    jax_gaussian_nb: bool = False,
+                                    n_jobs: int = 1
                                     ):
         """ Performs hyperparameter optimization.
 
@@ -147,20 +249,36 @@ class Evaluation(object):
             trials (int):
             name (str):
             save_result (Boolean):
+            jax_gaussian_nb (Boolean): Fit and predict a GaussianNB with the jitted JAX kernels (requires jax)
+            n_jobs (int): Number of trials proposed per batch and fitted in parallel
 
         Returns:
             tuple (float): MRR and nDCG
 
         """
-
-        @use_named_args(search_space)
-        def evaluate(**params):
-            model.set_params(**params)
-            return -1 * self.compute_metrics(model, X, y, X_val, val_pair, qrels_val, k, components_pca, pairwise_model,
-                                             pairwise_top_k, pairwise_train, name=name)[0]
+        use_jax = jax_gaussian_nb and isinstance(model, GaussianNB)
+        names = [dimension.name for dimension in search_space]
 
         X, y, X_test, test_pair, X_val, val_pair = split_and_scale(X_y_train, X_test, X_val, components_pca)
-        best_result = gp_minimize(evaluate, search_space, n_calls=trials)
+        val_results = self.results_frame(val_pair, qrels_val)
+        optimizer = Optimizer(search_space, base_estimator='GP', acq_optimizer='lbfgs')
+        for start in range(0, trials, n_jobs):
+            batch_size = min(n_jobs, trials - start)
+            # Asking for n_points copies the optimizer and refits the GP, which only pays off for real batches
+            points = [optimizer.ask()] if batch_size == 1 else optimizer.ask(n_points=batch_size, strategy='cl_min')
+            batch = [dict(zip(names, point)) for point in points]
+            confidences = Parallel(n_jobs=n_jobs)(
+                delayed(_predict_proba)(clone(model).set_params(**params), X, y, X_val, use_jax) for params in batch)
+
+            scores = []
+            for params, val_confidences in zip(batch, confidences):
+                scores.append(-1 * self.compute_metrics(model.set_params(**params), X, y, X_val, val_pair, qrels_val,
+                                                        k, components_pca, pairwise_model, pairwise_top_k,
+                                                        pairwise_train, name=name, confidences=val_confidences,
+                                                        results_buf=val_results)[0])
+            optimizer.tell(points, scores)
+
+        best_result = optimizer.get_result()
         print(f'Best MRR: {-1 * best_result.fun}')
         print(f'Best Hyperparameters: {best_result.x}')
 
@@ -172,6 +290,7 @@ class Evaluation(object):
                                                     k, components_pca,
                                                     pairwise_model, pairwise_top_k, pairwise_train,
                                                     name=name, save_result=save_result)
+        self.flush()
         print(f'MRR on test set: {test_set_performance[0]}')
         print(f'nDCG on test set: {test_set_performance[1]}')
 
@@ -206,6 +325,8 @@ class Evaluation(object):
         features = list(X.columns)
         added_columns = []
         performances = []
+        # GaussianNB likelihoods are additive over features, so candidates are scored without refitting
+        naive_bayes = IncrementalGaussianNB(model, X, y, X_test) if isinstance(model, GaussianNB) else None
 
         current_best = (None, 0)
         current_performance = -1
@@ -214,6 +335,7 @@ class Evaluation(object):
                 if feature in added_columns:
                     continue
                 print(f'Testing features: {added_columns + [feature]}')
+                confidences = naive_bayes.predict_proba(feature)[:, 1] if naive_bayes is not None else None
                 performance = self.compute_metrics(model,
                                                    X[added_columns + [feature]],
                                                    y,
@@ -223,18 +345,22 @@ class Evaluation(object):
                                                    k,
                                                    components_pca,
                                                    name=name,
-                                                   save_result=save_results)[1]
+                                                   save_result=save_results,
+                                                   confidences=confidences)[1]
                 if performance > current_performance and performance > current_best[1]:
                     current_best = (feature, performance)
             if current_best[0] is not None:
                 current_performance = current_best[1]
                 added_columns.append(current_best[0])
                 performances.append(current_performance)
+                if naive_bayes is not None:
+                    naive_bayes.add(current_best[0])
             else:
                 break
             current_best = (None, 0)
             print(f'Current features: {added_columns}')
             print(f'Current Performance: {current_performance}')
+        self.flush()
 
         print(f'Best feature combination: {added_columns}')
         print(f'MRR: {current_performance}')
@@ -253,7 +379,9 @@ class Evaluation(object):
                         pairwise_top_k: int = 50,
                         pairwise_train: bool = True,
                         name: str = None,
-                        save_result: bool = False):
+                        save_result: bool = False,
+                        confidences=None,
+                        results_buf: pd.DataFrame = None):
         """ Computes metrics.
 
         Args:
@@ -270,107 +398,129 @@ class Evaluation(object):
             pairwise_train (Boolean):
             name (str):
             save_result (Boolean):
+            confidences (np.ndarray): Precomputed relevance probabilities of X_test, skips fitting the model
+            results_buf (pd.DataFrame): Frame from results_frame for test_pair and qrels whose confidences are
+                overwritten instead of building and joining a new one
 
         Returns:
             MRR (float):
 
         """
-        model.fit(X, y)
-        confidences = pd.DataFrame(model.predict_proba(X_test))[1]
-
-        results = pd.DataFrame({
-            'confidence': confidences,
-            'qID': list(test_pair['qID']),
-            'pID': list(test_pair['pID']),
-            'relevant': [0] * len(confidences)
-        })
-        for i, qrel in qrels.iterrows():
-            results.loc[((results['pID'] == qrel['pID']) & (results['qID'] == qrel['qID'])), 'relevant'] = qrel[
-                'feedback']
+        if confidences is None:
+            model.fit(X, y)
+            confidences = model.predict_proba(X_test)[:, 1]
+
+        if results_buf is None:
+            results = self.results_frame(test_pair, qrels)
+        elif pairwise_model is not None:
+            # pairwise_optimize reorders the frame in place
+            results = results_buf.copy()
+        else:
+            results = results_buf
+        results.loc[:, 'confidence'] = np.asarray(confidences, dtype=np.float64)
 
         if pairwise_model is not None:
             results = pairwise_optimize(pairwise_model, results, X, y, X_test, pairwise_top_k, pairwise_train)
 
-        mrr = self.mean_reciprocal_rank(results)
-        map = self.mean_average_precision_score(results)
-        ndcg = self.mean_normalized_discounted_cumulative_gain_score(results)
+        ap, ndcg, rr = self.query_metrics(results)
+        mrr = rr.mean()
+        map = ap.mean()
+        ndcg = ndcg.mean()
         metrics = self.metrics(results)
         k_metrics = self.metrics(results, k)
 
         if save_result:
-            self.results = pd.concat([self.results,
-                                      pd.DataFrame({'name': name,
-                                                    'model': str(model),
-                                                    'hyperparameters': str(model.get_params()),
-                                                    'pairwise_model': pairwise_model,
-                                                    'pairwise_k': pairwise_top_k if pairwise_model is not None else None,
-                                                    'features': json.dumps(list(X.columns)),
-                                                    'sampling_training': len(X),
-                                                    'sampling_test': len(X_test),
-                                                    'pca': components_pca,
-                                                    'MRR': mrr,
-                                                    'MAP': map,
-                                                    'nDCG': ndcg,
-                                                    'accuracy': metrics[0],
-                                                    'precision': metrics[1],
-                                                    'recall': metrics[2],
-                                                    'f1': metrics[3],
-                                                    f'accuracy@{k}': k_metrics[0],
-                                                    f'precision@{k}': k_metrics[1],
-                                                    f'recall@{k}': k_metrics[2],
-                                                    f'f1@{k}': k_metrics[3]
-                                                    }, index=[0])]).reset_index(drop=True)
-            save(self.results, self.previous_results)
+            self._pending.append({'name': name,
+                                  'model': str(model),
+                                  'hyperparameters': str(model.get_params()),
+                                  'pairwise_model': pairwise_model,
+                                  'pairwise_k': pairwise_top_k if pairwise_model is not None else None,
+                                  'features': json.dumps(list(X.columns)),
+                                  'sampling_training': len(X),
+                                  'sampling_test': len(X_test),
+                                  'pca': components_pca,
+                                  'MRR': mrr,
+                                  'MAP': map,
+                                  'nDCG': ndcg,
+                                  'accuracy': metrics[0],
+                                  'precision': metrics[1],
+                                  'recall': metrics[2],
+                                  'f1': metrics[3],
+                                  f'accuracy@{k}': k_metrics[0],
+                                  f'precision@{k}': k_metrics[1],
+                                  f'recall@{k}': k_metrics[2],
+                                  f'f1@{k}': k_metrics[3]})
 
         return mrr, ndcg
 
-    def calculate_ranks(self, results: pd.DataFrame):
-        """ Calculates ranks.
+    def results_frame(self, test_pair: pd.DataFrame, qrels: pd.DataFrame):
+        """ Creates the results frame of a test set with its feedback joined and empty confidences.
 
         Args:
+            test_pair (pd.DataFrame): qID and pID of every test row
+            qrels (pd.DataFrame): Feedback per qID and pID
+
+        Returns:
             results (pd.DataFrame):
 
+        """
+        results = pd.DataFrame({
+            'confidence': np.zeros(len(test_pair), dtype=np.float64),
+            'qID': test_pair['qID'].to_numpy(),
+            'pID': test_pair['pID'].to_numpy()
+        }, copy=False)
+        judgements = qrels.drop_duplicates(['qID', 'pID'], keep='last').set_index(['qID', 'pID'])['feedback']
+        pairs = pd.MultiIndex.from_arrays([results['qID'], results['pID']])
+        results['relevant'] = judgements.reindex(pairs).fillna(0).astype(np.int8).to_numpy()
+        return results
+
+    def query_metrics(self, results: pd.DataFrame, threshold: int = 3):
+        """ Calculates AP, nDCG and RR of every query in a single pass.
+
+        Args:
+            results (pd.DataFrame): Confidence and relevance of all query-passage pairs
+            threshold (int): Minimum feedback for a document to count as a hit for RR
+
         Returns:
-            ranks (pd.DataFrame):
+            AP (np.ndarray): Average precision per query
+            nDCG (np.ndarray): Normalized discounted cumulative gain per query
+            RR (np.ndarray): Reciprocal rank per query
 
         """
-        ranks = results.sort_values('confidence', ascending=False)
-        ranks['rank'] = np.arange(1, len(ranks) + 1)
-        ranks = ranks[ranks['relevant'] >= 1]
-        ranks.index = np.arange(1, len(ranks) + 1)
-        return ranks
+        qids, relevant = self._all_ranks(results)
+        qid_offsets = np.r_[0, np.flatnonzero(qids[1:] != qids[:-1]) + 1, len(qids)].astype(np.int32)
+        # One vectorized log2 over all ranks instead of a scalar call per hit inside the kernel
+        discounts = 1. / np.log2(np.arange(2, np.diff(qid_offsets).max(initial=0) + 2, dtype=np.float64))
+        return _query_metrics(relevant, qid_offsets, discounts, threshold)
 
-    def average_precision_score(self, results: pd.DataFrame):
-        """ Calculates average precision score.
+    def _all_ranks(self, results: pd.DataFrame):
+        """ Orders the documents of all queries with a single stable sort by qID and descending confidence.
 
         Args:
-            results (pd.DataFrame):
+            results (pd.DataFrame): Confidence and relevance of all query-passage pairs
 
         Returns:
-            AP (float):
+            qIDs (np.ndarray): qID of every document in ranked order
+            relevant (np.ndarray): Feedback of every document in ranked order
 
         """
-        ranks = self.calculate_ranks(results)
-        sum = 0
-        for index, data in ranks.iterrows():
-            sum += index / data['rank']
-        return sum / len(ranks)
+        qids = results['qID'].to_numpy()
+        order = np.lexsort((-results['confidence'].to_numpy(), qids))
+        return qids[order], results['relevant'].to_numpy()[order]
 
     def mean_average_precision_score(self, results: pd.DataFrame):
         """ Calculates mean average precision score.
 
+        Use query_metrics to compute several metrics with a single ranking pass.
+
         Args:
-            results (pd.DataFrame):
+            results (pd.DataFrame): Confidence and relevance of all query-passage pairs
 
         Returns:
             MAP (float):
 
         """
-        qIDs = results['qID'].unique()
-        sum = 0
-        for qID in qIDs:
-            sum += self.average_precision_score(results[results['qID'] == qID])
-        return sum / len(qIDs)
+        return self.query_metrics(results)[0].mean()
 
     def metrics(self, results: pd.DataFrame, k: int = None):
         """ Calculates metrics (accuracy, precision, recall, f1).
@@ -389,10 +539,15 @@ class Evaluation(object):
         if k is not None:
             results = results.sort_values('confidence', ascending=False).groupby('qID').head(k)
 
-        tp = len(results[(results['confidence'] >= 0.5) & (results['relevant'] >= 1)])
-        fp = len(results[(results['confidence'] >= 0.5) & (results['relevant'] == 0)])
-        tn = len(results[(results['confidence'] < 0.5) & (results['relevant'] == 0)])
-        fn = len(results[(results['confidence'] < 0.5) & (results['relevant'] >= 1)])
+        conf = results['confidence'].to_numpy()
+        rel = results['relevant'].to_numpy()
+        pos = conf >= 0.5
+        relv = rel >= 1
+
+        tp = int(np.count_nonzero(pos & relv))
+        fp = int(np.count_nonzero(pos) - tp)
+        fn = int(np.count_nonzero(relv) - tp)
+        tn = len(conf) - tp - fp - fn
 
         accuracy = (tp + tn) / (tp + fp + tn + fn)
         try:
@@ -409,60 +564,31 @@ class Evaluation(object):
             f_score = np.nan
         return accuracy, precision, recall, f_score
 
-    def normalized_discounted_cumulative_gain(self, results: pd.DataFrame):
-        """ Calculates normalized discounted cumulative gain.
-
-        Args:
-            results (pd.DataFrame):
-
-        Returns:
-            nDCG (float):
-
-        """
-        ranks = self.calculate_ranks(results)
-        dcg = 0
-        idcg = 0
-        for index, data in ranks.sort_values('relevant', ascending=False).reset_index().iterrows():
-            dcg += (2 ** data['relevant'] - 1) / np.log2(data['rank'] + 1)
-            idcg += (2 ** data['relevant'] - 1) / np.log2((index + 1) + 1)
-        return dcg / idcg
-
     def mean_normalized_discounted_cumulative_gain_score(self, results: pd.DataFrame):
         """ Calculates mean normalized discounted cumulative gain score.
 
+        Use query_metrics to compute several metrics with a single ranking pass.
+
         Args:
-            results (pd.DataFrame):
+            results (pd.DataFrame): Confidence and relevance of all query-passage pairs
 
         Returns:
             Mean of nDCG (float):
 
         """
-        qIDs = results['qID'].unique()
-        sum = 0
-        for qID in qIDs:
-            sum += self.normalized_discounted_cumulative_gain(results[results['qID'] == qID])
-        return sum / len(qIDs)
+        return self.query_metrics(results)[1].mean()
 
     def mean_reciprocal_rank(self, results: pd.DataFrame, threshold: int = 3):
         """ Calculates mean reciprocal rank.
 
+        Use query_metrics to compute several metrics with a single ranking pass.
+
         Args:
-            results (pd.DataFrame):
+            results (pd.DataFrame): Confidence and relevance of all query-passage pairs
+            threshold (int): Minimum feedback for a document to count as a hit
 
         Returns:
             MRR (float):
 
         """
-        qIDs = results['qID'].unique()
-        sum = 0
-
-        for qID in qIDs:
-            ranks = self.calculate_ranks(results[results['qID'] == qID])
-            if len(ranks[ranks['relevant'] >= threshold]) > 0:
-                ranks = ranks[ranks['relevant'] >= threshold]
-            else:
-                ranks = ranks[ranks['relevant'] >= (threshold - 1)]
-            ranks = ranks.sort_values('rank', ascending=True).head(1)
-            sum += (1 / float(ranks['rank']))
-
-        return sum / len(qIDs)
+        return self.query_metrics(results, threshold)[2].mean()
@@ -384,7 +384,8 @@ class Pipeline(object):
 
     def evaluate(self, name: str = None, model: str = 'nb', pca: int = 0,
                  pairwise_model: str = None, pairwise_top_k: int = 50, search_space: list = None, trials: int = 20,
-                 models_path: str = None, store_model_path: str = None):
+                 models_path: str = None, store_model_path: str = None, jax_gaussian_nb: bool = False,
+                 n_jobs: int = 1):
         """ Evaluates the performance of the model.
 
         Args:
@@ -396,6 +397,8 @@ class Pipeline(object):
             search_space (list):
             models_path (str):
             store_model_path (str): Path to store model to
+            jax_gaussian_nb (bool): Whether GaussianNB trials of the hyperparameter search run on JAX
+            n_jobs (int): Number of hyperparameter trials to run in parallel
 
         Returns:
             none
@@ -442,7 +445,8 @@ class Pipeline(object):
             evaluation.hyperparameter_optimization(model_to_test, search_space, self.features,
                                                    self.features_test, self.features_val,
                                                    self.qrels_test, self.qrels_val, 50, pca, pairwise_model,
-                                                   pairwise_top_k, pairwise_train, trials=trials, name=name)
+                                                   pairwise_top_k, pairwise_train, trials=trials, name=name,
+                                                   jax_gaussian_nb=jax_gaussian_nb, n_jobs=n_jobs)
         else:
             evaluation(self.features, self.features_test, self.qrels_test, 50, pca, model_to_test, pairwise_model,
                        pairwise_top_k, pairwise_train, name=name)